@@ -0,0 +1,130 @@
+import argparse
+import time
+import numpy as np
+import torch
+import torch.utils.data as Data
+from sklearn import mixture
+from sklearn.metrics import adjusted_rand_score
+
+from trajectoryPlugin.embed import EMBEDDINGS
+from trajectoryPlugin.cluster import BACKENDS
+from trajectoryPlugin.plugin import API
+from networks import ConvNet, WideResNet
+
+
+def synthetic_trajectory(n_samples, n_epochs, n_groups, noise=0.05, seed=0):
+	"""
+	Correct-class probability curves of `n_groups` kinds of samples (fast/slow learners,
+	never learned, ...) as logistic curves with random rate and onset plus noise.
+	"""
+	rng = np.random.RandomState(seed)
+	groups = rng.randint(n_groups, size=n_samples)
+	rate = np.linspace(0.05, 1., n_groups)[groups] * rng.uniform(0.8, 1.2, n_samples)
+	onset = np.linspace(0, n_epochs, n_groups)[groups] * rng.uniform(0.8, 1.2, n_samples)
+	epochs = np.arange(n_epochs)
+	traject = 1. / (1. + np.exp(-rate[:, None] * (epochs[None, :] - onset[:, None])))
+	traject += noise * rng.randn(n_samples, n_epochs)
+	return np.asfortranarray(np.clip(traject, 0, 1).astype(np.float32)), groups
+
+
+def timed_cluster(X, num_cluster):
+	start = time.time()
+	gmm = mixture.GaussianMixture(n_components=num_cluster, covariance_type='full', max_iter=500, tol=1e-5, init_params='kmeans', verbose=0)
+	gmm.fit(X)
+	labels = gmm.predict(X)
+	return labels, time.time() - start
+
+
+def bench_embedding(args):
+	traject, groups = synthetic_trajectory(args.n_samples, args.n_epochs, args.num_cluster, seed=args.seed)
+	raw_labels, raw_time = timed_cluster(traject, args.num_cluster)
+	print('| embedding | width | fit time (s) | ARI vs truth | ARI vs raw |')
+	print('| raw | {} | {:.3f} | {:.4f} | 1.0000 |'.format(traject.shape[1], raw_time, adjusted_rand_score(groups, raw_labels)))
+	for name, embedding in sorted(EMBEDDINGS.items()):
+		embedder = embedding(args.embed_dim)
+		start = time.time()
+		for i in range(traject.shape[1]):
+			embedder.update(traject[:, :i+1])
+		update_time = (time.time() - start) / traject.shape[1]
+		start = time.time()
+		X = embedder.transform(traject)
+		transform_time = time.time() - start
+		labels, fit_time = timed_cluster(X, args.num_cluster)
+		print('| {} | {} | {:.3f} (+{:.3f} transform, {:.4f}/epoch update) | {:.4f} | {:.4f} |'.format(name, X.shape[1], fit_time, transform_time,
+			update_time, adjusted_rand_score(groups, labels), adjusted_rand_score(raw_labels, labels)))
+
+
+def bench_backends(args):
+	traject, groups = synthetic_trajectory(args.n_samples, args.n_epochs, args.num_cluster, seed=args.seed)
+	labels = groups % 10 # stand-in training labels for the class-conditional backends
+	print('| backend | clusters | fit time (s) | peak host memory (MB) | ARI vs truth |')
+	for name in sorted(BACKENDS):
+		backend = BACKENDS[name](args.num_cluster, trace_memory=True)
+		cluster_output = backend.fit_predict(traject, labels)
+		print('| {} | {} | {:.3f} | {:.1f} | {:.4f} |'.format(name, backend.n_clusters, backend.report['fit_time'],
+			backend.report.get('host_memory', 0) / 2.**20, adjusted_rand_score(groups, cluster_output)))
+
+
+def synthetic_images(n_samples, shape, seed=0):
+	generator = torch.Generator().manual_seed(seed)
+	return Data.TensorDataset(torch.randn((n_samples,) + shape, generator=generator), torch.randint(10, (n_samples,), generator=generator))
+
+
+def bench_similarity(args):
+	device = 'cuda' if torch.cuda.is_available() else 'cpu'
+	print('| dataset | similarity | time (s) | pearson vs full | sign agreement vs full |')
+	for dataset, shape, net in [('mnist', (1, 28, 28), ConvNet()), ('cifar10', (3, 32, 32), WideResNet(16, 10, 2))]:
+		net = net.to(device)
+		sims = {}
+		for similarity in ['full', 'last-layer']:
+			api = API(num_cluster=args.num_cluster, device=device, similarity=similarity)
+			api.dataLoader(synthetic_images(args.n_images, shape, args.seed), synthetic_images(args.n_images // 10, shape, args.seed + 1), batch_size=128)
+			api.cluster_output = api.train_dataset.tensors[1].numpy() % args.num_cluster # class-structured clusters
+			start = time.time()
+			sims[similarity] = api._similarity(net, args.num_cluster).cpu().numpy()
+			elapsed = time.time() - start
+			print('| {} | {} | {:.3f} | {:.4f} | {:.2f} |'.format(dataset, similarity, elapsed, np.corrcoef(sims['full'], sims[similarity])[0, 1],
+				np.mean(np.sign(sims['full']) == np.sign(sims[similarity]))))
+
+
+def bench_sketch(args):
+	device = 'cuda' if torch.cuda.is_available() else 'cpu'
+	net = WideResNet(16, 10, 2).to(device)
+	n_params = sum(w.numel() for w in net.parameters() if w.requires_grad)
+	trainset, validset = synthetic_images(args.n_images, (3, 32, 32), args.seed), synthetic_images(args.n_images // 10, (3, 32, 32), args.seed + 1)
+	print('| sketch dim | gradient memory (MB) | time (s) | max abs cosine error | mean abs cosine error |')
+	exact = None
+	for sketch_dim in [None] + args.sketch_dims:
+		api = API(num_cluster=args.num_cluster, device=device, sketch_dim=sketch_dim, sketch_seed=args.seed)
+		api.dataLoader(trainset, validset, batch_size=128)
+		api.cluster_output = api.train_dataset.tensors[1].numpy() % args.num_cluster
+		start = time.time()
+		sims = api._similarity(net, args.num_cluster).cpu().numpy()
+		elapsed = time.time() - start
+		exact = sims if exact is None else exact
+		print('| {} | {:.1f} | {:.3f} | {:.4f} | {:.4f} |'.format(sketch_dim or 'exact', (args.num_cluster + 1) * (sketch_dim or n_params) * 4 / 2.**20,
+			elapsed, np.max(np.abs(sims - exact)), np.mean(np.abs(sims - exact))))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Trajectory plugin benchmarks on synthetic data')
+	parser.add_argument('task', type=str, help='benchmark = [embedding/backends/similarity/sketch]')
+	parser.add_argument('--n_samples', type=int, default=50000, help='number of training samples (default: 50000)')
+	parser.add_argument('--n_epochs', type=int, default=200, help='trajectory length (default: 200)')
+	parser.add_argument('--num_cluster', type=int, default=6, help='number of cluster (default: 6)')
+	parser.add_argument('--n_images', type=int, default=10000, help='number of synthetic images for the similarity benchmark (default: 10000)')
+	parser.add_argument('--sketch_dims', type=int, nargs='+', default=[1024, 4096, 16384, 65536], help='sketch dimensions to compare (default: 1024 4096 16384 65536)')
+	parser.add_argument('--embed_dim', type=int, default=8, help='embedding width (default: 8)')
+	parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+	args = parser.parse_args()
+
+	np.random.seed(args.seed)
+	{
+		'embedding': bench_embedding,
+		'backends': bench_backends,
+		'similarity': bench_similarity,
+		'sketch': bench_sketch,
+	}[args.task](args)
+
+if __name__ == '__main__':
+	main()
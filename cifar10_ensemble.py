@@ -11,12 +11,14 @@ from networks import *
 
 from trajectoryPlugin.plugin import API
 
-def train_fn(model, device, optimizer, api, reweight=False):
+def train_fn(model, device, optimizer, api, reweight=False, record=False):
 	model.train()
 	for batch_idx, (data, target, weight) in enumerate(api.train_loader):
 		data, target, weight = data.to(device), target.to(device), weight.to(device)
 		optimizer.zero_grad()
 		output = model(data)
+		if record:
+			api.recordBatch(api.rand_idx[batch_idx], output, target)
 		if reweight:
 			loss = api.loss_func(output, target, weight, 'mean')
 		else:
@@ -83,6 +85,7 @@ def main():
 	parser.add_argument('--weight_update_rate', type=float, default=0.1, help='weight update rate (default: 0.1)')
 	parser.add_argument('--burn_in', type=int, default=5, help='number of burn-in epochs (default: 5)')
 	parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+	parser.add_argument('--record_mode', type=str, default='eval', help='trajectory recording = [eval/train] (default: eval)')
 	parser.add_argument('--save_model', action='store_true', default=False, help='For Saving the current Model')
 
 	args = parser.parse_args()
@@ -150,14 +153,14 @@ def main():
 	reweight_test_loss = []
 	reweight_test_accuracy = []
 
-	api = API(num_cluster=args.num_cluster, device=device, update_rate=args.weight_update_rate, iprint=2)
+	api = API(num_cluster=args.num_cluster, device=device, update_rate=args.weight_update_rate, record_mode=args.record_mode, iprint=2)
 	api.dataLoader(trainset, validset, batch_size=args.batch_size)
 	scheduler_standard = torch.optim.lr_scheduler.MultiStepLR(optimizer_standard, milestones=[60,120,160], gamma=0.2)
 
 	for epoch in range(1, args.burn_in + 1):
 
 		scheduler_standard.step()
-		train_fn(model_standard, device, optimizer_standard, api, False)
+		train_fn(model_standard, device, optimizer_standard, api, False, args.record_mode == 'train')
 		api.createTrajectory(model_standard)
 		
 		loss, accuracy = forward_fn(model_standard, device, api, 'train')
@@ -214,7 +217,7 @@ def main():
 		standard_test_accuracy.append(accuracy)
 
 		scheduler_reweight.step()
-		train_fn(model_reweight, device, optimizer_reweight, api, True)
+		train_fn(model_reweight, device, optimizer_reweight, api, True, args.record_mode == 'train')
 		api.createTrajectory(model_reweight)
 		if epoch >= args.burn_in and (epoch - args.burn_in) % args.reweight_interval == 0:
 			api.clusterTrajectory() 
@@ -43,6 +43,7 @@ parser.add_argument('--depth', default=28, type=int, help='depth of model')
 parser.add_argument('--widen_factor', default=10, type=int, help='width of model')
 parser.add_argument('--dropout', default=0., type=float, help='dropout_rate')
 parser.add_argument('--dataset', default='cifar10', type=str, help='dataset = [cifar10/cifar100]')
+parser.add_argument('--record_mode', default='eval', type=str, help='trajectory recording = [eval/train]')
 
 args = parser.parse_args()
 
@@ -95,7 +96,7 @@ testset = Subset(testset, test_idx)
 validloader = torch.utils.data.DataLoader(validset, batch_size=batch_size, shuffle=False)
 testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=2)
 
-api = API(num_cluster=args.cluster_num, device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"), iprint=2)
+api = API(num_cluster=args.cluster_num, device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"), record_mode=args.record_mode, iprint=2)
 api.dataLoader(trainset, validset, batch_size=batch_size)
 
 # Return network & file name
@@ -167,6 +168,8 @@ def train(epoch):
         inputs, targets = Variable(inputs), Variable(targets)
 
         outputs = net(inputs)               # Forward Propagation
+        if args.record_mode == 'train':
+            api.recordBatch(api.rand_idx[batch_idx], outputs, targets)
         loss = api.loss_func(outputs, targets, weights)  # Loss
 
         loss.backward()  # Backward Propagation
@@ -12,12 +12,14 @@ from networks import *
 
 from trajectoryPlugin.plugin import API
 
-def train_fn(model, device, optimizer, api, reweight=False):
+def train_fn(model, device, optimizer, api, reweight=False, record=False):
 	model.train()
 	for batch_idx, (data, target, weight) in enumerate(api.train_loader):
 		data, target, weight = data.to(device), target.to(device), weight.to(device)
 		optimizer.zero_grad()
 		output = model(data)
+		if record:
+			api.recordBatch(api.rand_idx[batch_idx], output, target)
 		if reweight:
 			loss = api.loss_func(output, target, weight, 'mean')
 		else:
@@ -81,6 +83,7 @@ def main():
 	parser.add_argument('--reweight_interval', type=int, default=1, help='number of epochs between reweighting')
 	parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
 	parser.add_argument('--weight_update_rate', type=float, default=0.1, help='weight update rate (default: 0.1)')
+	parser.add_argument('--record_mode', type=str, default='eval', help='trajectory recording = [eval/train] (default: eval)')
 	parser.add_argument('--save_model', action='store_true', default=False, help='For Saving the current Model')
 	
 	args = parser.parse_args()
@@ -150,14 +153,14 @@ def main():
 	reweight_test_loss = []
 	reweight_test_accuracy = []
 
-	api = API(num_cluster=args.num_cluster, device=device, update_rate=args.weight_update_rate, iprint=2)
+	api = API(num_cluster=args.num_cluster, device=device, update_rate=args.weight_update_rate, record_mode=args.record_mode, iprint=2)
 	api.dataLoader(trainset, validset, batch_size=args.batch_size)
 	scheduler_standard = torch.optim.lr_scheduler.StepLR(optimizer_standard, step_size=1, gamma=0.95)
 
 	for epoch in range(1, args.burn_in + 1):
 
 		scheduler_standard.step()
-		train_fn(model_standard, device, optimizer_standard, api, False)
+		train_fn(model_standard, device, optimizer_standard, api, False, args.record_mode == 'train')
 		api.createTrajectory(model_standard)
 		
 		loss, accuracy = forward_fn(model_standard, device, api, 'train')
@@ -205,9 +208,10 @@ def main():
 
 	epoch_reweight.append({'epoch':epoch, 'weight_tensor':api.weight_tensor.data.cpu().numpy().tolist()})
 	mean_trajectory = {}
-	for cid in range(api.num_cluster):
+	for cid in range(api.clusterer.n_clusters):
 		cidx = (api.cluster_output==cid).nonzero()[0].tolist()
-		mean_trajectory.update({cid:np.mean(api.traject_bins[cidx], axis=0).tolist()})
+		bins = np.mean(api.traject_bins[cidx], axis=0)
+		mean_trajectory.update({cid:[np.concatenate((bins[0::2], bins[1::2])).tolist()]})
 	epoch_trajectory.append({'epoch':epoch, 'trajectory':mean_trajectory})
 
 	for epoch in range(args.burn_in + 1, args.epochs + 1):
@@ -228,7 +232,7 @@ def main():
 		standard_test_accuracy.append(accuracy)
 
 		scheduler_reweight.step()
-		train_fn(model_reweight, device, optimizer_reweight, api, True)
+		train_fn(model_reweight, device, optimizer_reweight, api, True, args.record_mode == 'train')
 		api.createTrajectory(model_reweight)
 
 		loss, accuracy = forward_fn(model_reweight, device, api, 'train')
@@ -249,9 +253,10 @@ def main():
 			api.reweightData(model_reweight, noise_idx)
 			epoch_reweight.append({'epoch':epoch, 'weight_tensor':api.weight_tensor.data.cpu().numpy().tolist()})
 			mean_trajectory = {}
-			for cid in range(api.num_cluster):
+			for cid in range(api.clusterer.n_clusters):
 				cidx = (api.cluster_output==cid).nonzero()[0].tolist()
-				mean_trajectory.update({cid:np.mean(api.traject_bins[cidx], axis=0).tolist()})
+				bins = np.mean(api.traject_bins[cidx], axis=0)
+				mean_trajectory.update({cid:[np.concatenate((bins[0::2], bins[1::2])).tolist()]})
 			epoch_trajectory.append({'epoch':epoch, 'trajectory':mean_trajectory})
 		api.generateTrainLoader()
 		sys.stdout.flush()
@@ -0,0 +1,295 @@
+import time, tracemalloc, functools
+import multiprocessing
+import numpy as np
+import torch
+from sklearn import mixture, cluster
+from trajectoryPlugin.gmm import GaussianMixture
+from trajectoryPlugin.parallel import SharedMatrix
+
+
+BACKENDS = {}
+
+def register(name):
+	def wrap(backend):
+		BACKENDS[name] = backend
+		return backend
+	return wrap
+
+
+class ClusterBackend:
+	"""
+	Clustering backend of the trajectory plugin, selected by name with API(cluster_backend=...).
+
+		note: subclasses implement `fit(X, y)` and `predict(X, y)`, `y` holds the training labels
+		for class-conditional backends. `fit_predict` records fit time in `self.report`, plus
+		peak host memory (tracemalloc, slows every allocation) and peak device memory on cuda
+		if `trace_memory` is set.
+	"""
+
+	def __init__(self, num_cluster, device='cpu', batch_size=4096, warm_start=False, warm_max_iter=50, n_init=1, n_jobs=1, trace_memory=False):
+		self.num_cluster = num_cluster
+		self.trace_memory = trace_memory
+		self.n_jobs = n_jobs
+		self.device = device
+		self.batch_size = batch_size
+		self.warm_start = warm_start
+		self.warm_max_iter = warm_max_iter
+		self.n_init = n_init
+		self.report = {}
+
+	@property
+	def n_clusters(self):
+		return self.num_cluster
+
+	def to(self, device):
+		self.device = device
+		return self
+
+	def fit(self, X, y=None):
+		raise NotImplementedError
+
+	def predict(self, X, y=None):
+		raise NotImplementedError
+
+	def bic(self, X):
+		raise NotImplementedError('{} has no likelihood to select the cluster number with'.format(type(self).__name__))
+
+	def score(self, X):
+		"""
+		Average log likelihood of the rows of X, None for backends without a likelihood.
+		"""
+		return None
+
+	def fit_predict(self, X, y=None, sample=None, chunk_size=None):
+		"""
+		Fit on the rows `sample` of X (all rows if None), then assign every row of X in
+		chunks of `chunk_size` rows so only one chunk of X and of the responsibilities is live.
+		"""
+		tracing = not self.trace_memory or tracemalloc.is_tracing()
+		if not tracing:
+			tracemalloc.start()
+		cuda = self.trace_memory and torch.cuda.is_available() and torch.device(self.device).type == 'cuda'
+		if cuda:
+			torch.cuda.reset_max_memory_allocated(self.device)
+		start = time.time()
+		if sample is None:
+			self.fit(X, y)
+		else:
+			self.fit(X[sample], None if y is None else y[sample])
+		self.report.update({'fit_time': time.time() - start})
+		labels = self.assign(X, y, chunk_size)
+		self.report.update({'predict_time': time.time() - start - self.report['fit_time']})
+		if not tracing:
+			self.report.update({'host_memory': tracemalloc.get_traced_memory()[1]})
+			tracemalloc.stop()
+		if cuda:
+			self.report.update({'device_memory': torch.cuda.max_memory_allocated(self.device)})
+		return labels
+
+	def assign(self, X, y=None, chunk_size=None):
+		"""
+		Cluster ids of every row of X under the current fit, `chunk_size` rows at a time.
+		"""
+		chunk_size = chunk_size or X.shape[0]
+		labels = np.empty(X.shape[0], dtype=np.int64)
+		for i in range(0, X.shape[0], chunk_size):
+			labels[i:i+chunk_size] = self.predict(X[i:i+chunk_size], None if y is None else y[i:i+chunk_size])
+		return labels
+
+
+@register('sklearn-full')
+class SklearnFullGMM(ClusterBackend):
+	"""
+	sklearn full-covariance GMM, warm-started from the previous fit when `warm_start` is set.
+	"""
+
+	model = None
+
+	def _warmStartInit(self, X):
+		"""
+		Extend the previous mixture to the columns of X with one M-step, using the
+		responsibilities of the previous fit on the columns it has seen.
+		"""
+		resp = self.model.predict_proba(X[:, :self.model.means_.shape[1]])
+		nk = resp.sum(axis=0) + 10 * np.finfo(resp.dtype).eps
+		means = np.dot(resp.T, X) / nk[:, np.newaxis]
+		precisions = np.empty((self.num_cluster, X.shape[1], X.shape[1]))
+		for k in range(self.num_cluster):
+			diff = X - means[k]
+			covariance = np.dot(resp[:, k] * diff.T, diff) / nk[k]
+			covariance.flat[::X.shape[1] + 1] += self.model.reg_covar
+			precisions[k] = np.linalg.inv(covariance)
+		return nk / X.shape[0], means, precisions
+
+	def fit(self, X, y=None):
+		warm = self.warm_start and self.model is not None and self.model.means_.shape[1] <= X.shape[1]
+		if warm:
+			weights, means, precisions = self._warmStartInit(X)
+			self.model = mixture.GaussianMixture(n_components=self.num_cluster, covariance_type='full', max_iter=self.warm_max_iter, tol=1e-5,
+				weights_init=weights, means_init=means, precisions_init=precisions, verbose=0)
+		else:
+			self.model = mixture.GaussianMixture(n_components=self.num_cluster, covariance_type='full', max_iter=500, tol=1e-5, init_params='kmeans', verbose=0)
+		self.model.fit(X)
+		if warm:
+			self.report.update({'iterations': self.model.n_iter_, 'saved_iterations': self.cold_iter - self.model.n_iter_})
+		else:
+			self.cold_iter = self.model.n_iter_
+			self.report.update({'iterations': self.model.n_iter_})
+
+	def predict(self, X, y=None):
+		return self.model.predict(X)
+
+	def bic(self, X):
+		return self.model.bic(X)
+
+	def score(self, X):
+		return self.model.score(X)
+
+
+@register('torch-diag')
+class TorchDiagGMM(ClusterBackend):
+	"""
+	Diagonal-covariance torch GaussianMixture on `device`, `n_init` restarts fitted in one batch.
+	"""
+
+	def to(self, device):
+		self.device = device
+		if hasattr(self, 'model'):
+			self.model = self.model.to(device)
+		return self
+
+	def fit(self, X, y=None):
+		self.model = GaussianMixture(self.num_cluster, X.shape[1], n_init=self.n_init, iprint=0).to(self.device)
+		self.model.fit(X)
+		self.report.update({'iterations': self.model.n_iter_})
+
+	def predict(self, X, y=None):
+		return self.model.predict(X, prob=False, chunk_size=self.batch_size)
+
+	def bic(self, X):
+		n_parameters = 2 * self.num_cluster * X.shape[1] + self.num_cluster - 1
+		return -2 * self.model.log_marginal_likelihood(X) * X.shape[0] + n_parameters * np.log(X.shape[0])
+
+	def score(self, X):
+		total = 0.
+		for i in range(0, X.shape[0], self.batch_size):
+			total += self.model.log_marginal_likelihood(X[i:i+self.batch_size]) * X[i:i+self.batch_size].shape[0]
+		return total / X.shape[0]
+
+
+@register('online')
+class OnlineGMM(TorchDiagGMM):
+	"""
+	Diagonal-covariance torch GaussianMixture fitted by mini-batch EM, fixed memory footprint.
+	"""
+
+	def fit(self, X, y=None):
+		self.model = GaussianMixture(self.num_cluster, X.shape[1], iprint=0).to(self.device)
+		self.model.fit_online(X, batch_size=self.batch_size)
+		self.report.update({'iterations': self.model.n_iter_})
+
+
+@register('minibatch-kmeans')
+class MiniBatchKMeans(ClusterBackend):
+	"""
+	sklearn mini-batch k-means, the cheapest backend for very large trajectory sets.
+	"""
+
+	def fit(self, X, y=None):
+		self.model = cluster.MiniBatchKMeans(n_clusters=self.num_cluster, batch_size=self.batch_size, n_init=3)
+		self.model.fit(X)
+		self.report.update({'iterations': self.model.n_iter_})
+
+	def predict(self, X, y=None):
+		return self.model.predict(X)
+
+
+def fit_subset(matrix, backend, rows):
+	"""
+	Pool worker of class-conditional clustering: fit `backend` on the given rows of the shared matrix.
+	"""
+	backend.fit(matrix.array()[rows])
+	return backend
+
+
+class ClassConditional(ClusterBackend):
+	"""
+	One `base` backend per training label, cluster ids are `label_index * num_cluster + local id`.
+
+		note: with n_jobs > 1 the per-class fits run on a process pool sharing X.
+	"""
+
+	def __init__(self, num_cluster, base='sklearn-full', **kwargs):
+		super(ClassConditional, self).__init__(num_cluster, **kwargs)
+		self.base = base
+		self.kwargs = kwargs
+		self.models = {}
+
+	@property
+	def n_clusters(self):
+		return len(self.classes) * self.num_cluster
+
+	def to(self, device):
+		self.device = self.kwargs['device'] = device
+		for model in self.models.values():
+			model.to(device)
+		return self
+
+	def fit(self, X, y=None):
+		assert y is not None, 'class-conditional clustering needs the training labels'
+		self.classes = np.unique(y)
+		rows = [np.nonzero(y == label)[0] for label in self.classes]
+		models = [self.models.get(label) or BACKENDS[self.base](min(self.num_cluster, len(cidx)), **self.kwargs)
+			for label, cidx in zip(self.classes, rows)]
+		if self.n_jobs > 1:
+			matrix = SharedMatrix(X)
+			pool = multiprocessing.Pool(min(self.n_jobs, len(models)))
+			# the pool forks, the children must not touch cuda
+			models = pool.starmap(fit_subset, [(matrix, model.to('cpu'), cidx) for model, cidx in zip(models, rows)])
+			pool.close()
+			pool.join()
+			matrix.release()
+			models = [model.to(self.device) for model in models]
+		else:
+			for model, cidx in zip(models, rows):
+				model.fit(X[cidx])
+		self.models = dict(zip(self.classes, models))
+
+	def predict(self, X, y=None):
+		unseen = np.setdiff1d(np.unique(y), self.classes)
+		if len(unseen) > 0:
+			raise ValueError('labels {} were not in the class-conditional fit'.format(unseen.tolist()))
+		labels = np.empty(X.shape[0], dtype=np.int64)
+		for i, label in enumerate(self.classes):
+			cidx = np.nonzero(y == label)[0]
+			if len(cidx) > 0:
+				labels[cidx] = i * self.num_cluster + self.models[label].predict(X[cidx])
+		return labels
+
+def fit_bic(matrix, name, num_cluster, kwargs, sample=None):
+	"""
+	Pool worker of the cluster number sweep: fit backend `name` with `num_cluster` clusters on
+	the shared matrix (rows `sample` only if given), return (num_cluster, bic, fit time) and
+	the fitted backend so the winner is not fitted again.
+	"""
+	start = time.time()
+	X = matrix.array()
+	if sample is not None:
+		X = X[sample]
+	backend = BACKENDS[name](num_cluster, **kwargs)
+	backend.fit(X)
+	backend.report.update({'fit_time': time.time() - start})
+	return (num_cluster, backend.bic(X), time.time() - start), backend
+
+
+def fit_cluster(matrix, backend, y=None, sample=None, chunk_size=None):
+	"""
+	Pool worker of asynchronous clustering: fit_predict on the shared matrix, return the
+	fitted backend (it carries warm-start state and the report) and the cluster ids.
+	"""
+	labels = backend.fit_predict(matrix.array(), y, sample, chunk_size)
+	return backend, labels
+
+
+for name in ['sklearn-full', 'torch-diag', 'online', 'minibatch-kmeans']:
+	BACKENDS['class-' + name] = functools.partial(ClassConditional, base=name)
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class PCAEmbedding:
+	"""
+	Projection on the top `dim` principal axes of the trajectory.
+
+		note: the Gram matrix and column sums grow by one row/column per epoch (O(N·E)),
+		so a refit only needs an E x E eigendecomposition and one N x E x dim product. Both
+		run over `chunk_size` rows at a time, a memmap trajectory is never copied whole.
+	"""
+
+	def __init__(self, dim=8, chunk_size=65536):
+		self.dim = dim
+		self.chunk_size = chunk_size
+		self.gram = np.zeros((0, 0))
+		self.col_sum = np.zeros(0)
+
+	def update(self, traject):
+		x = np.asarray(traject[:, -1], dtype=np.float64)
+		cross = np.zeros(traject.shape[1] - 1)
+		for i in range(0, traject.shape[0], self.chunk_size):
+			cross += np.dot(np.asarray(traject[i:i+self.chunk_size, :-1], dtype=np.float64).T, x[i:i+self.chunk_size])
+		gram = np.empty((self.gram.shape[0] + 1,) * 2)
+		gram[:-1, :-1] = self.gram
+		gram[:-1, -1] = gram[-1, :-1] = cross
+		gram[-1, -1] = np.dot(x, x)
+		self.gram = gram
+		self.col_sum = np.append(self.col_sum, x.sum())
+
+	def transform(self, traject):
+		n = traject.shape[0]
+		mean = self.col_sum / n
+		eig_val, eig_vec = np.linalg.eigh(self.gram / n - np.outer(mean, mean))
+		axes = eig_vec[:, ::-1][:, :self.dim]
+		# eigh leaves the sign of each axis arbitrary, fix it so refits see comparable embeddings
+		axes = axes * np.sign(axes[np.argmax(np.abs(axes), axis=0), np.arange(axes.shape[1])])
+		mean, axes = mean.astype(np.float32), axes.astype(np.float32)
+		embedded = np.zeros((n, self.dim), dtype=np.float32)
+		for i in range(0, n, self.chunk_size):
+			embedded[i:i+self.chunk_size, :axes.shape[1]] = np.dot(traject[i:i+self.chunk_size] - mean, axes)
+		return embedded
+
+
+class RandomEmbedding:
+	"""
+	Gaussian random projection of the trajectory, each epoch's projection row is drawn from
+	`seed + epoch` so the embedding is accumulated in O(N·dim) per epoch.
+	"""
+
+	def __init__(self, dim=8, seed=0):
+		self.dim = dim
+		self.seed = seed
+		self.embedded = None
+
+	def update(self, traject):
+		epoch = traject.shape[1] - 1
+		row = np.random.RandomState(self.seed + epoch).randn(self.dim).astype(np.float32) / np.sqrt(self.dim)
+		if self.embedded is None:
+			self.embedded = np.zeros((traject.shape[0], self.dim), dtype=np.float32)
+		self.embedded += np.outer(traject[:, -1], row)
+
+	def transform(self, traject):
+		return self.embedded
+
+
+class ChebyshevEmbedding:
+	"""
+	Least-squares Chebyshev coefficients of each trajectory over the epochs seen so far,
+	a degree `dim - 1` summary of the curve shape.
+	"""
+
+	def __init__(self, dim=8):
+		self.dim = dim
+
+	def update(self, traject):
+		pass
+
+	def transform(self, traject):
+		epochs = np.linspace(-1, 1, traject.shape[1]) if traject.shape[1] > 1 else np.zeros(1)
+		vander = np.polynomial.chebyshev.chebvander(epochs, self.dim - 1)
+		return np.dot(traject, np.linalg.pinv(vander).T.astype(np.float32))
+
+
+EMBEDDINGS = {
+	'pca': PCAEmbedding,
+	'random': RandomEmbedding,
+	'chebyshev': ChebyshevEmbedding,
+}
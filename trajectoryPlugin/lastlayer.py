@@ -0,0 +1,69 @@
+import torch
+import torch.nn as nn
+
+
+class LastLayerGrad:
+	"""
+	Closed-form cross entropy gradient of the classifier layer, from the penultimate features
+	captured by a forward hook: d loss / d [W, b] = (softmax - onehot) ⊗ [h, 1].
+
+		note: the classifier is `fc` (WideResNet, nn.Linear) or `classifier` (ConvNet, a 1x1
+		nn.Conv2d followed by a global average pool, so h is the spatial mean of its input).
+		DataParallel models are unwrapped through `.module`.
+	"""
+
+	def __init__(self, net):
+		net = getattr(net, 'module', net)
+		self.layer = net.fc if hasattr(net, 'fc') else getattr(net, 'classifier', None)
+		assert isinstance(self.layer, (nn.Linear, nn.Conv2d)), 'last-layer similarity needs an `fc` or `classifier` layer'
+		self.features = None
+		self.handle = self.layer.register_forward_hook(self._hook)
+
+	def _hook(self, module, inputs, output):
+		h = inputs[0].detach()
+		if h.dim() == 4:
+			h = h.mean((2, 3))
+		self.features = torch.cat((h, torch.ones(h.shape[0], 1, device=h.device, dtype=h.dtype)), 1)
+
+	@property
+	def n_params(self):
+		return sum(w.numel() for w in self.layer.parameters())
+
+	def residual(self, output, target):
+		residual = torch.softmax(output.detach(), 1)
+		residual[torch.arange(target.shape[0], device=target.device), target] -= 1
+		return residual
+
+	def grad(self, output, target):
+		"""
+		Summed gradient of the last forward batch, flattened in the order of
+		`layer.parameters()` (weight, then bias).
+		"""
+		g = torch.mm(self.residual(output, target).t(), self.features)
+		return torch.cat((g[:, :-1].reshape(-1), g[:, -1]))
+
+	def group_grad(self, output, target, group, n_groups):
+		"""
+		Summed gradient of the samples of every group of the last forward batch, shape
+		(n_groups, n_params); `group` holds each sample's group id.
+		"""
+		mask = torch.zeros(n_groups, target.shape[0], device=output.device)
+		mask[group, torch.arange(target.shape[0], device=output.device)] = 1
+		g = torch.einsum('kb,bc,bd->kcd', mask, self.residual(output, target), self.features)
+		return torch.cat((g[:, :, :-1].reshape(n_groups, -1), g[:, :, -1]), 1)
+
+	def sample_cosine(self, output, target, valid_grad):
+		"""
+		Cosine of every sample's gradient in the last forward batch with the flat gradient
+		`valid_grad`, shape (batch_size,). With G the (C, D+1) matrix of `valid_grad`,
+		<r ⊗ h, G> = r·G·h and |r ⊗ h| = |r|·|h|, no per-sample gradient is formed.
+		"""
+		residual = self.residual(output, target)
+		n_classes = residual.shape[1]
+		valid_grad = torch.cat((valid_grad[:-n_classes].reshape(n_classes, -1), valid_grad[-n_classes:, None]), 1)
+		dot = torch.sum(torch.mm(residual, valid_grad) * self.features, 1)
+		norm = torch.norm(residual, 2, 1) * torch.norm(self.features, 2, 1) * torch.norm(valid_grad)
+		return dot / norm.clamp(min=1e-12)
+
+	def remove(self):
+		self.handle.remove()
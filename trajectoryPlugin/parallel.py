@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+import torch.utils.data as Data
+from multiprocessing import shared_memory
+
+
+class SharedMatrix:
+	"""
+	Picklable handle on a feature matrix for pool workers. A column-major np.memmap view
+	starting at the head of its file (a MemmapTrajectoryStore view) is reopened from the
+	file unless `copy` asks for a snapshot, any other array is copied once into a shared
+	memory block.
+
+		note: the creating process owns the block and must call `release()` when done.
+	"""
+
+	def __init__(self, X, copy=False):
+		self.shape, self.dtype = X.shape, X.dtype
+		self.order = 'F' if X.flags.f_contiguous and not X.flags.c_contiguous else 'C'
+		if not copy and isinstance(X, np.memmap) and X.filename is not None and self.order == 'F':
+			self.filename, self.offset, self.name = X.filename, X.offset, None
+		else:
+			self.filename = None
+			self.shm = shared_memory.SharedMemory(create=True, size=max(1, X.nbytes))
+			self.name = self.shm.name
+			np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf, order=self.order)[:] = X
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.pop('shm', None)
+		return state
+
+	def array(self):
+		if self.filename is not None:
+			return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape, order=self.order)
+		if not hasattr(self, 'shm'):
+			self.shm = shared_memory.SharedMemory(name=self.name)
+		return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf, order=self.order)
+
+	def release(self):
+		if self.name is not None:
+			self.shm.close()
+			self.shm.unlink()
+
+
+_grad_worker = {}
+
+def init_grad_worker(net, dataset, loss_func, batch_size, n_threads):
+	"""
+	Initializer of the cluster gradient pool (fork start method): the model replica shares its
+	parameters with the parent, `n_threads` intra-op threads per worker avoid oversubscription.
+	"""
+	torch.set_num_threads(n_threads)
+	_grad_worker.update({'net': net, 'dataset': dataset, 'loss_func': loss_func, 'batch_size': batch_size})
+
+
+def cluster_grads(grads, cids, cluster_output, sketch=None):
+	"""
+	Pool worker of parallel reweighting: accumulate the summed loss gradient of every cluster
+	in `cids` into its row of the shared n_clusters x P tensor `grads`, one pass over the
+	samples of these clusters in cluster order so a batch spans one or two clusters.
+	"""
+	net, loss_func = _grad_worker['net'], _grad_worker['loss_func']
+	params = [w for w in net.parameters() if w.requires_grad]
+	rows = np.nonzero(np.isin(cluster_output, cids))[0]
+	rows = rows[np.argsort(cluster_output[rows], kind='stable')]
+	loader = Data.DataLoader(Data.dataset.Subset(_grad_worker['dataset'], rows.tolist()), batch_size=_grad_worker['batch_size'], shuffle=False)
+	group = torch.from_numpy(cluster_output[rows])
+	start = 0
+	for data, target in loader:
+		batch_group = group[start:start+target.shape[0]]
+		start += target.shape[0]
+		loss = loss_func(net(data), target, None, None)
+		for cid in torch.unique(batch_group).tolist():
+			cluster_grad = torch.autograd.grad(loss[batch_group == cid].sum(), params, retain_graph=True, allow_unused=True)
+			if sketch:
+				grads[cid] += sketch(cluster_grad, params)
+			else:
+				grads[cid] += torch.cat([g.reshape(-1) if g is not None else torch.zeros(w.numel()) for g, w in zip(cluster_grad, params)])
+	return cids
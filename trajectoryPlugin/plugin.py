@@ -3,11 +3,16 @@ import torch.nn as nn
 import torch.utils.data as Data
 import torchvision
 import numpy as np
-from trajectoryPlugin.gmm import GaussianMixture
 from trajectoryPlugin.collate import default_collate as core_collate
-from sklearn import mixture
-from scipy import spatial
-import sys, logging
+from trajectoryPlugin.store import TrajectoryStore, MemmapTrajectoryStore, TrajectoryBins
+from trajectoryPlugin.embed import EMBEDDINGS
+from trajectoryPlugin.cluster import BACKENDS, ClusterBackend, fit_bic, fit_cluster
+from trajectoryPlugin.parallel import SharedMatrix, init_grad_worker, cluster_grads
+from trajectoryPlugin.lastlayer import LastLayerGrad
+from trajectoryPlugin.sketch import GradientSketch
+import sys, time, logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -66,12 +71,78 @@ class API:
 		note: this api will handle dataset during training, see example.
 	"""
 
-	traject_matrix = None  # type: ndarray
-	cluster_matrix = None  # type: ndarray
+	traject_store = None  # type: TrajectoryStore
+	cluster_store = None  # type: TrajectoryStore
 	
-	def __init__(self, num_cluster=6, device='cpu', update_rate=0.1, iprint=0):
+	def __init__(self, num_cluster=6, device='cpu', update_rate=0.1, list_prob=False, num_epochs=None,
+				trajectory_backend='memory', trajectory_path=None, resume=False, record_mode='eval',
+				warm_start=False, warm_max_iter=50, cluster_backend='sklearn-full', cluster_batch_size=4096,
+				embedding=None, embed_dim=8, fit_subsample=None, stratify=True, predict_chunk_size=65536,
+				k_candidates=None, sweep_workers=None, sweep_budget=None, async_cluster=False,
+				recluster_tol=None, recluster_ll_tol=None, reassign=True, class_conditional=False, class_workers=1, trace_cluster_memory=False,
+				similarity='full', similarity_estimator='exact', sample_tol=0.05, sample_budget=None, valid_batch_size=1024,
+				sketch_dim=None, sketch_seed=0, weight_mode='cluster', grad_workers=1, iprint=0):
+		if class_conditional and not cluster_backend.startswith('class-'):
+			cluster_backend = 'class-' + cluster_backend
+		assert trajectory_backend in ['memory', 'memmap']
+		assert embedding is None or embedding in EMBEDDINGS
+		assert cluster_backend in BACKENDS
+		assert record_mode in ['eval', 'train']
+		assert not k_candidates or getattr(BACKENDS[cluster_backend], 'bic', ClusterBackend.bic) is not ClusterBackend.bic, \
+			'the cluster number sweep needs a backend with a BIC (sklearn-full, torch-diag, online)'
+		assert similarity in ['full', 'last-layer']
+		assert not (cluster_backend.startswith('class-') and fit_subsample and not stratify), 'class-conditional subsamples must be stratified to cover every label'
+		assert similarity_estimator in ['exact', 'sampled']
+		assert weight_mode in ['cluster', 'sample']
+		assert not (async_cluster and k_candidates), 'the cluster number sweep runs synchronously, it cannot be combined with async_cluster'
+		assert grad_workers == 1 or torch.device(device).type == 'cpu', 'the cluster gradient pool forks, cpu only'
+		assert trajectory_backend == 'memory' or trajectory_path is not None, 'memmap backend needs a trajectory_path'
 		self.num_cluster = num_cluster
 		self.update_rate = update_rate
+		self.list_prob = list_prob # fall back to the per-sample numpy path in createTrajectory
+		self.num_epochs = num_epochs # planned epoch count, fixes the trajectory store capacity
+		self.trajectory_backend = trajectory_backend
+		self.trajectory_path = trajectory_path
+		self.resume = resume # continue from an existing memmap trajectory file
+		self.record_mode = record_mode # 'train' fills the trajectory from recordBatch during the training pass
+		self.record_column = None
+		self.cluster_backend = cluster_backend # name in trajectoryPlugin.cluster.BACKENDS
+		self.cluster_batch_size = cluster_batch_size
+		self.class_workers = class_workers # process pool size for the per-class fits of class-* backends
+		self.trace_cluster_memory = trace_cluster_memory # add peak host/device memory to the backend report (tracemalloc slows the fit)
+		self.warm_start = warm_start # sklearn-full refits from the previous mixture extended to the new feature columns
+		self.warm_max_iter = warm_max_iter
+		self.clusterer = None
+		self.fit_subsample = fit_subsample # fit the mixture on this many rows, then assign the full set
+		self.stratify = stratify # draw the subsample per training label
+		self.predict_chunk_size = predict_chunk_size
+		self.k_candidates = k_candidates # choose num_cluster among these by BIC at every clustering
+		self.sweep_workers = sweep_workers
+		self.sweep_budget = sweep_budget # seconds, candidates still running afterwards are dropped
+		self.async_cluster = async_cluster # fit in a background process, applied at the next epoch boundary
+		self.cluster_pool = None
+		self.cluster_pending = None
+		self.cluster_output = None
+		self.recluster_tol = recluster_tol # skip the refit while the mean per-sample move since the last fit stays below this
+		self.recluster_ll_tol = recluster_ll_tol # ... and the last fit's avg log likelihood on the new features dropped less than this
+		self.reassign = reassign # on a skipped refit, relabel with the previous fit if the feature width is unchanged and no embedding is active
+		self.fit_column = None
+		self.fit_score = None
+		self.refits = 0
+		self.skipped_refits = 0
+		self.embedding = embedding # fixed-width projection of the trajectory ahead of clusterTrajectory
+		self.embed_dim = embed_dim
+		self.similarity = similarity # 'last-layer' compares closed-form classifier gradients, no backward pass
+		self.similarity_estimator = similarity_estimator # 'sampled' draws cluster batches until the full-gradient cosine settles
+		self.sample_tol = sample_tol # half-width of the 95% confidence interval of the sampled cosine
+		self.sample_budget = sample_budget # max samples drawn per cluster, None for the cluster size
+		self.sample_report = {}
+		self.valid_batch_size = valid_batch_size # batch size of the validation gradient over the cached validation set
+		self.grad_workers = grad_workers # processes computing the exact full cluster gradients on cpu
+		self.grad_pool = None
+		self.grad_pool_net = None
+		self.weight_mode = weight_mode # 'sample' moves every weight by its own last-layer gradient cosine, no clustering needed
+		self.sketch = GradientSketch(sketch_dim, sketch_seed) if sketch_dim else None # full-gradient similarity between CountSketches
 		self.loss_func = WeightedCrossEntropyLoss()
 		self.device = device
 		self.logger = logging.getLogger(__name__)
@@ -104,11 +175,65 @@ class API:
 		self.batch_size = batch_size
 		self.train_dataset = trainset
 		self.valid_loader = Data.DataLoader(validset, batch_size=self.batch_size, shuffle=True)
+		self._cacheValidset(validset)
 		self.weight_raw = torch.tensor(np.ones(self.train_dataset.__len__(), dtype=np.float32), requires_grad=False)
 		self.weight_tensor = self._normalize(self.weight_raw)
-		self.traject_matrix = np.empty((self.train_dataset.__len__(), 0))
-		self.cluster_matrix = np.empty((self.train_dataset.__len__(), 0))
+		self.train_labels = np.zeros(self.train_dataset.__len__(), dtype=np.int64) # filled by createTrajectory
+		self.traject_store = self._createStore('', np.float32, 1, self.resume)
+		self.cluster_store = self._createStore('.cluster', np.int64, 1, self.resume)
+		self.bins = TrajectoryBins(self._createStore('.bins', np.float32, 2, False), window=3)
+		self.embedder = EMBEDDINGS[self.embedding](self.embed_dim) if self.embedding else None
+		for i in range(len(self.traject_store)): # replay a resumed trajectory
+			self.bins.append_epoch(self.traject_store.view()[:, i])
+			if self.embedder:
+				self.embedder.update(self.traject_store.view()[:, :i+1])
 		self.generateTrainLoader()
+
+	def _cacheValidset(self, validset):
+		"""
+		Run the validation set through its transforms once and keep it as two contiguous
+		tensors, on the device for cuda (pinned host memory if it does not fit), on the host otherwise.
+		"""
+		data, target = [], []
+		for x, y in Data.DataLoader(validset, batch_size=self.valid_batch_size, shuffle=False):
+			data.append(x)
+			target.append(y)
+		self.valid_data, self.valid_target = torch.cat(data).contiguous(), torch.cat(target).contiguous()
+		if torch.device(self.device).type == 'cuda':
+			try:
+				self.valid_data, self.valid_target = self.valid_data.to(self.device), self.valid_target.to(self.device)
+			except RuntimeError:
+				self.valid_data, self.valid_target = self.valid_data.pin_memory(), self.valid_target.pin_memory()
+
+	def _validBatches(self):
+		for i in range(0, self.valid_target.shape[0], self.valid_batch_size):
+			data = self.valid_data[i:i+self.valid_batch_size].to(self.device, non_blocking=True)
+			target = self.valid_target[i:i+self.valid_batch_size].to(self.device, non_blocking=True)
+			yield data, target
+
+	def _createStore(self, suffix, dtype, width, resume):
+		capacity = width * self.num_epochs if self.num_epochs else None
+		if self.trajectory_backend == 'memmap':
+			return MemmapTrajectoryStore(self.trajectory_path + suffix, self.train_dataset.__len__(), capacity, dtype, resume=resume)
+		return TrajectoryStore(self.train_dataset.__len__(), capacity, dtype)
+
+	def _appendTrajectory(self, prob_output):
+		self.traject_store.append_epoch(prob_output)
+		self.bins.append_epoch(prob_output)
+		if self.embedder:
+			self.embedder.update(self.traject_store.view())
+
+	@property
+	def traject_matrix(self):
+		if self.traject_store is None:
+			return None
+		return self.traject_store.view()
+
+	@property
+	def cluster_matrix(self):
+		if self.cluster_store is None:
+			return None
+		return self.cluster_store.view()
 		
 	def log(self, msg, level):
 		if self.iprint >= level:
@@ -124,86 +249,281 @@ class API:
 		return prob
 
 	def _softmax(self, x):
-		#e_x = np.exp(x - np.max(x))
-		#return e_x / e_x.sum(axis=0)
-		return np.exp(x) / np.sum(np.exp(x), axis=0)
-
-	def createTrajectory(self, torchnn):
+		e_x = np.exp(x - np.max(x))
+		return e_x / e_x.sum(axis=0)
+
+	def _correctProbTensor(self, output, y):
+		"""
+		Batched counterpart of `_correctProb`: log-softmax and label gather on the device,
+		returns a float32 tensor of shape (batch_size,).
+		"""
+		log_prob = torch.log_softmax(output.float(), 1)
+		return log_prob.gather(1, y.view(-1, 1)).squeeze(1).exp()
+
+	def recordBatch(self, batch_indices, output, target):
+		"""
+		Record the correct-class probability of one training batch from logits the train loop
+		already computed, `batch_indices` is `api.rand_idx[batch_idx]`.
+
+			note: logits come from train mode (dropout, batch statistics), see record_mode.
+		"""
+		if self.record_column is None:
+			self.record_column = torch.empty(self.train_dataset.__len__(), dtype=torch.float32, device=self.device)
+			self.record_seen = torch.zeros(self.train_dataset.__len__(), dtype=torch.uint8, device=self.device)
+			self.record_labels = torch.zeros(self.train_dataset.__len__(), dtype=torch.long, device=self.device)
+		with torch.no_grad():
+			idx = torch.tensor(batch_indices, dtype=torch.long, device=self.device)
+			self.record_column[idx] = self._correctProbTensor(output.detach(), target).to(self.device)
+			self.record_labels[idx] = target.to(self.device)
+			self.record_seen[idx] = 1
+
+	def createTrajectory(self, torchnn=None):
+		self.applyCluster(block=False)
+		if self.record_mode == 'train':
+			assert self.record_column is not None and bool(self.record_seen.all()), 'recordBatch did not cover the whole training set this epoch'
+			self.train_labels = self.record_labels.cpu().numpy()
+			self._appendTrajectory(self.record_column.cpu().numpy())
+			self.record_column = None
+			return
 		torchnn.eval()
 		with torch.no_grad():
-			prob_output = np.empty(self.train_dataset.__len__())
-			for step, (data, target, weight) in enumerate(self.train_loader):
-				data = data.to(self.device)
-				output = torchnn(data).data.cpu().numpy().tolist()
-				prob_output[self.rand_idx[step]] = self._correctProb(output, target.data.cpu().numpy())
-			self.traject_matrix = np.append(self.traject_matrix, np.matrix(prob_output).T, 1)
+			if self.list_prob:
+				prob_output = np.empty(self.train_dataset.__len__(), dtype=np.float32)
+				for step, (data, target, weight) in enumerate(self.train_loader):
+					data = data.to(self.device)
+					output = torchnn(data).data.cpu().numpy().tolist()
+					prob_output[self.rand_idx[step]] = self._correctProb(output, target.data.cpu().numpy())
+					self.train_labels[self.rand_idx[step]] = target.numpy()
+			else:
+				prob_column = torch.empty(self.train_dataset.__len__(), dtype=torch.float32, device=self.device)
+				for step, (data, target, weight) in enumerate(self.train_loader):
+					self.train_labels[self.rand_idx[step]] = target.numpy()
+					data, target = data.to(self.device), target.to(self.device)
+					idx = torch.tensor(self.rand_idx[step], dtype=torch.long, device=self.device)
+					prob_column[idx] = self._correctProbTensor(torchnn(data), target)
+				prob_output = prob_column.cpu().numpy()
+			self._appendTrajectory(prob_output)
 
 	def trajectoryBins(self):
-		bins = [self.traject_matrix[:,i:i+3] for i in range(0, self.traject_matrix.shape[1], 1)]
-		self.traject_bins = np.empty((self.train_dataset.__len__(), 0))
-		mean_traject = np.empty((self.train_dataset.__len__(), 0))
-		std_traject = np.empty((self.train_dataset.__len__(), 0))
-		for b in bins:
-			mean_traject = np.append(mean_traject, np.matrix(np.mean(b, axis=1)), 1)
-			std_traject = np.append(std_traject, np.matrix(np.std(b, axis=1)), 1)
-		self.traject_bins = np.append(self.traject_bins, mean_traject, 1)
-		self.traject_bins = np.append(self.traject_bins, std_traject, 1)
+		"""
+		3-epoch window features, kept up to date by createTrajectory.
+
+			note: columns are interleaved [mean_0, std_0, mean_1, std_1, ...].
+		"""
+		self.traject_bins = self.bins.view()
+
+	def _flatten(self, grads, params):
+		"""
+		Gradients `grads` of `params` (None for unused ones) as one flat tensor on the device,
+		or as its `sketch_dim` CountSketch in sketch mode.
+		"""
+		if self.sketch:
+			return self.sketch(grads, params)
+		return torch.cat([g.detach().reshape(-1) if g is not None else torch.zeros(w.numel(), device=w.device)
+			for g, w in zip(grads, params)])
+
+	def _cosine(self, grads, valid_grads):
+		"""
+		Cosine similarity of every row of the K x P matrix `grads` with `valid_grads`, one matmul.
+		"""
+		norm = torch.norm(grads, 2, 1) * torch.norm(valid_grads, 2)
+		return torch.mv(grads, valid_grads) / norm.clamp(min=1e-12)
 
 	def _validGrad(self, validNet):
-		valid_grads = []
+		"""
+		Gradient of the summed validation loss over the cached validation set, computed once
+		per reweightData call.
+		"""
+		params = [w for w in validNet.parameters() if w.requires_grad]
 		validNet.eval()
-		validNet.zero_grad()
-		for step, (data, target) in enumerate(self.valid_loader):
+		valid_grads = 0
+		for data, target in self._validBatches():
+			valid_loss = self.loss_func(validNet(data), target, None, 'sum')
+			valid_grads = valid_grads + self._flatten(torch.autograd.grad(valid_loss, params, allow_unused=True), params)
+		return valid_grads
+
+	def _clusterGrads(self, validNet, n_clusters):
+		"""
+		Gradient of every cluster's summed training loss, stacked as a n_clusters x P matrix on
+		the device (zero rows for empty clusters). One pass over the training set in cluster
+		order, so a batch spans one or two clusters: each batch is forwarded once and its
+		per-cluster loss sums, formed with a cluster mask, are backpropagated into the rows of
+		the clusters present in the batch.
+		"""
+		if self.grad_workers > 1:
+			return self._parallelClusterGrads(validNet, n_clusters)
+		params = [w for w in validNet.parameters() if w.requires_grad]
+		cluster_grads = torch.zeros(n_clusters, self.sketch.dim if self.sketch else sum(w.numel() for w in params), device=self.device)
+		order = np.argsort(self.cluster_output, kind='stable')
+		cluster_output = torch.from_numpy(np.asarray(self.cluster_output, dtype=np.int64)[order])
+		train_loader = Data.DataLoader(Data.dataset.Subset(self.train_dataset, order.tolist()), batch_size=self.batch_size, shuffle=False)
+		start = 0
+		for step, (data, target) in enumerate(train_loader):
 			data, target = data.to(self.device), target.to(self.device)
-			valid_output = validNet(data)
-			valid_loss = self.loss_func(valid_output, target, None, 'mean')
-			valid_loss.backward()
-		for w in validNet.parameters():
-			if w.requires_grad:
-				valid_grads.extend(list(w.grad.cpu().detach().numpy().flatten()))
-		validNet.zero_grad()
-		return np.array(valid_grads)
+			group = cluster_output[start:start+target.shape[0]]
+			start += target.shape[0]
+			mask = torch.zeros(n_clusters, target.shape[0], device=self.device)
+			mask[group.to(self.device), torch.arange(target.shape[0], device=self.device)] = 1
+			cluster_loss = torch.mv(mask, self.loss_func(validNet(data), target, None, None))
+			for cid in torch.unique(group).tolist():
+				grads = torch.autograd.grad(cluster_loss[cid], params, retain_graph=True, allow_unused=True)
+				cluster_grads[cid] += self._flatten(grads, params)
+		return cluster_grads
+
+	def _parallelClusterGrads(self, validNet, n_clusters):
+		"""
+		_clusterGrads on a forked process pool: the workers' model replicas share validNet's
+		parameters (created once per model), each worker fills the rows of its clusters in a
+		shared n_clusters x P tensor, clusters are spread over the workers by size.
+		"""
+		if self.grad_pool_net is not validNet:
+			if self.grad_pool is not None:
+				self.grad_pool.terminate()
+			validNet.share_memory()
+			n_threads = max(1, torch.get_num_threads() // self.grad_workers)
+			self.grad_pool = torch.multiprocessing.get_context('fork').Pool(self.grad_workers, initializer=init_grad_worker,
+				initargs=(validNet, self.train_dataset, self.loss_func, self.batch_size, n_threads))
+			self.grad_pool_net = validNet
+		params = [w for w in validNet.parameters() if w.requires_grad]
+		grads = torch.zeros(n_clusters, self.sketch.dim if self.sketch else sum(w.numel() for w in params)).share_memory_()
+		cluster_output = np.asarray(self.cluster_output, dtype=np.int64)
+		sizes = np.bincount(cluster_output, minlength=n_clusters)
+		shards, load = [[] for w in range(self.grad_workers)], np.zeros(self.grad_workers)
+		for cid in np.argsort(-sizes)[:np.count_nonzero(sizes)].tolist(): # largest cluster to the least loaded worker
+			worker = int(np.argmin(load))
+			shards[worker].append(cid)
+			load[worker] += sizes[cid]
+		self.grad_pool.starmap(cluster_grads, [(grads, shard, cluster_output, self.sketch) for shard in shards if shard])
+		return grads
+
+	def _sampledClusterGrads(self, validNet, n_clusters, valid_grads):
+		"""
+		Mean batch gradient of every cluster from random batches, drawn until the 95% confidence
+		interval of its cosine with `valid_grads`, z·std(a_b)/(sqrt(n)·|ḡ|) with a_b the batch
+		gradients projected on the validation direction, is narrower than `sample_tol` or
+		`sample_budget` samples were drawn. Samples used per cluster go to `self.sample_report`.
+		"""
+		params = [w for w in validNet.parameters() if w.requires_grad]
+		valid_dir = valid_grads / torch.norm(valid_grads, 2).clamp(min=1e-12)
+		cluster_grads = torch.zeros(n_clusters, valid_grads.numel(), device=self.device)
+		self.sample_report = {}
+		for cid in range(n_clusters):
+			cidx = (self.cluster_output==cid).nonzero()[0]
+			if len(cidx) == 0:
+				continue
+			budget = min(len(cidx), self.sample_budget or len(cidx))
+			subset = torch.utils.data.dataset.Subset(self.train_dataset, np.random.permutation(cidx)[:budget].tolist())
+			subset_loader = Data.DataLoader(subset, batch_size=self.batch_size, shuffle=False)
+			grad_sum, proj, n_samples = 0, [], 0
+			for step, (data, target) in enumerate(subset_loader):
+				data, target = data.to(self.device), target.to(self.device)
+				subset_loss = self.loss_func(validNet(data), target, None)
+				grads = self._flatten(torch.autograd.grad(subset_loss, params, allow_unused=True), params)
+				grad_sum = grad_sum + grads
+				proj.append(torch.dot(grads, valid_dir).item())
+				n_samples += target.shape[0]
+				if len(proj) > 1:
+					half_width = 1.96 * np.std(proj, ddof=1) / (np.sqrt(len(proj)) * torch.norm(grad_sum / len(proj), 2).item() + 1e-12)
+					if half_width < self.sample_tol:
+						break
+			cluster_grads[cid] = grad_sum / len(proj)
+			self.sample_report[cid] = n_samples
+		self.log('| - samples used per cluster ' + str(self.sample_report), 2)
+		return cluster_grads
+
+	def _lastLayerGrads(self, validNet, n_clusters):
+		"""
+		Validation and per-cluster classifier gradients in closed form, one forward pass over
+		the validation set and one sequential pass over the training set.
+		"""
+		validNet = getattr(validNet, 'module', validNet) # one replica, so the hook sees whole batches
+		hook = LastLayerGrad(validNet)
+		cluster_output = torch.from_numpy(np.asarray(self.cluster_output, dtype=np.int64))
+		valid_grads = torch.zeros(hook.n_params, device=self.device)
+		cluster_grads = torch.zeros(n_clusters, hook.n_params, device=self.device)
+		train_loader = Data.DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=False)
+		try:
+			with torch.no_grad():
+				for data, target in self._validBatches():
+					valid_grads += hook.grad(validNet(data), target)
+				start = 0
+				for step, (data, target) in enumerate(train_loader):
+					data, target = data.to(self.device), target.to(self.device)
+					group = cluster_output[start:start+target.shape[0]].to(self.device)
+					cluster_grads += hook.group_grad(validNet(data), target, group, n_clusters)
+					start += target.shape[0]
+		finally:
+			hook.remove()
+		return valid_grads, cluster_grads
+
+	def _sampleSimilarity(self, validNet):
+		"""
+		Cosine of every training sample's closed-form classifier gradient with the validation
+		one, shape (N,) on the host, one sequential no-grad pass over the training set.
+		"""
+		validNet = getattr(validNet, 'module', validNet)
+		validNet.eval()
+		hook = LastLayerGrad(validNet)
+		valid_grads = torch.zeros(hook.n_params, device=self.device)
+		sims = torch.empty(self.train_dataset.__len__())
+		train_loader = Data.DataLoader(self.train_dataset, batch_size=self.valid_batch_size, shuffle=False)
+		try:
+			with torch.no_grad():
+				for data, target in self._validBatches():
+					valid_grads += hook.grad(validNet(data), target)
+				start = 0
+				for step, (data, target) in enumerate(train_loader):
+					data, target = data.to(self.device), target.to(self.device)
+					sims[start:start+target.shape[0]] = hook.sample_cosine(validNet(data), target, valid_grads).cpu()
+					start += target.shape[0]
+		finally:
+			hook.remove()
+		return sims
+
+	def _similarity(self, validNet, n_clusters):
+		"""
+		Cosine similarity of every cluster's training gradient with the validation gradient.
+		"""
+		validNet.eval() # eval mode, important!
+		if self.similarity == 'last-layer':
+			valid_grads, cluster_grads = self._lastLayerGrads(validNet, n_clusters)
+		elif self.similarity_estimator == 'sampled':
+			valid_grads = self._validGrad(validNet)
+			cluster_grads = self._sampledClusterGrads(validNet, n_clusters, valid_grads)
+		else:
+			valid_grads = self._validGrad(validNet)
+			cluster_grads = self._clusterGrads(validNet, n_clusters)
+		return self._cosine(cluster_grads, valid_grads)
 
 	def _normalize(self, tensor):
 		norm_fact = tensor.size()[0] / torch.sum(tensor)
 		return norm_fact * tensor
 
 	def reweightData(self, validNet, special_index=[]):
-		valid_grads = self._validGrad(validNet)
-		sim_dict = {}
-		validNet.eval() # eval mode, important!
-		for cid in range(self.num_cluster):
-			subset_grads = []
-			cidx = (self.cluster_output==cid).nonzero()[0].tolist()
-			size = len(cidx)
-			if size == 0:
-				continue
-			subset = torch.utils.data.dataset.Subset(self.train_dataset, cidx)
-			subset_loader = torch.utils.data.DataLoader(subset, batch_size=self.batch_size, shuffle=True)
-
-			validNet.zero_grad()
-			for step, (data, target) in enumerate(subset_loader):
-				data, target = data.to(self.device), target.to(self.device)
-				subset_output = validNet(data)
-				subset_loss = self.loss_func(subset_output, target, None)
-				subset_loss.backward()
-			for w in validNet.parameters():
-				if w.requires_grad:
-					subset_grads.extend(list(w.grad.cpu().detach().numpy().flatten()))
-
-			sim = 1 - spatial.distance.cosine(valid_grads, subset_grads)
-			sim_dict.update({cid : sim})
-
-		#update weights
-		for cid in range(self.num_cluster):
-			cidx = (self.cluster_output==cid).nonzero()[0].tolist()
-			size = len(cidx)
-			if size == 0:
-				continue
-			self.weight_raw[cidx] += self.update_rate * sim_dict[cid]
-			
+		if self.weight_mode == 'sample':
+			sims = self._sampleSimilarity(validNet)
+			self.weight_raw += self.update_rate * sims
+			self.log('| - ' + str({'mean sim': '{:.4f}'.format(sims.mean().item()), 'std sim': '{:.4f}'.format(sims.std().item())}), 2)
+			if special_index != []:
+				self.log('| - ' + str({'special mean sim': '{:.4f}'.format(sims[special_index].mean().item())}), 2)
+			self.weight_raw = self.weight_raw.clamp(0.001)
+			self.weight_tensor = self._normalize(self.weight_raw)
+			return
+
+		self.applyCluster(block=self.cluster_output is None) # a pending fit keeps the installed clustering until it finishes
+		n_clusters = self.clusterer.n_clusters
+		sims = self._similarity(validNet, n_clusters).cpu()
+		sim_dict = dict(enumerate(sims.numpy().tolist()))
+
+		#update weights, every sample moves by its cluster's similarity
+		cluster_output = torch.from_numpy(np.asarray(self.cluster_output, dtype=np.int64))
+		self.weight_raw += self.update_rate * sims[cluster_output]
+		sizes = np.bincount(self.cluster_output, minlength=n_clusters)
+		for cid in np.nonzero(sizes)[0].tolist():
+			size = sizes[cid]
 			#print some insights about noisy data
 			if special_index != []:
+				cidx = (self.cluster_output==cid).nonzero()[0].tolist()
 				num_special = self._specialRatio(cidx, special_index)
 				self.log('| - ' + str({cid:cid, 'size': size, 'sim': '{:.4f}'.format(sim_dict[cid]), 'num_special': num_special, 'spe_ratio':'{:.4f}'.format(num_special/size)}),2)
 			else:
@@ -215,18 +535,148 @@ class API:
 
 		validNet.zero_grad()
 
+	def _subsampleIndex(self, size):
+		n = self.train_dataset.__len__()
+		if not self.stratify:
+			return np.sort(np.random.choice(n, size, replace=False))
+		sample = []
+		for label in np.unique(self.train_labels):
+			cidx = np.nonzero(self.train_labels == label)[0]
+			sample.append(np.random.choice(cidx, max(1, int(round(len(cidx) * size / n))), replace=False))
+		return np.sort(np.concatenate(sample))
+
+	def _selectNumCluster(self, X, sample):
+		"""
+		Fit every candidate cluster number in parallel on a process pool sharing X and
+		return the fitted backend with the lowest BIC among those finished within `sweep_budget`.
+
+			note: workers fit on cpu, the winner is moved to the device afterwards. Candidates
+			are always fitted cold (no warm_start). If none finishes within the budget, the
+			first one to finish is taken.
+		"""
+		matrix = SharedMatrix(X)
+		pool = multiprocessing.Pool(self.sweep_workers or min(len(self.k_candidates), multiprocessing.cpu_count()))
+		kwargs = {'batch_size': self.cluster_batch_size}
+		jobs = [pool.apply_async(fit_bic, (matrix, self.cluster_backend, k, kwargs, sample)) for k in self.k_candidates]
+		deadline = time.time() + self.sweep_budget if self.sweep_budget else None
+		results = []
+		for job in jobs:
+			job.wait(None if deadline is None else max(0, deadline - time.time()))
+			if job.ready():
+				results.append(job.get())
+		if not results:
+			self.log('| - sweep: no candidate finished within {}s, waiting for the first one'.format(self.sweep_budget), 1)
+			while not results:
+				time.sleep(0.1)
+				results = [job.get() for job in jobs if job.ready()]
+		pool.terminate()
+		matrix.release()
+
+		for (k, bic, fit_time), backend in results:
+			self.log('| - sweep: num_cluster = {}, bic = {:.1f}, time = {:.2f}s'.format(k, bic, fit_time), 2)
+		(num_cluster, bic, fit_time), backend = min(results, key=lambda res: res[0][1])
+		self.log('| - sweep selected num_cluster = {} ({}/{} candidates finished)'.format(num_cluster, len(results), len(self.k_candidates)), 1)
+		return backend.to(self.device)
+
+	def _comparable(self, X, record):
+		"""
+		Whether the previous fit can score and relabel X: same width and not an embedding,
+		whose axes (PCA) or coordinates (random projection) move with every epoch.
+		"""
+		return X.shape[1] == self.fit_width and (record or self.embedder is None)
+
+	def _skipRecluster(self, X, record):
+		if self.recluster_tol is None or self.clusterer is None or self.fit_column is None:
+			return False
+		delta = np.mean(np.abs(self.traject_store.view()[:, -1] - self.fit_column))
+		self.log('| - mean trajectory change since the last fit = {:.5f}'.format(delta), 2)
+		if delta >= self.recluster_tol:
+			return False
+		if self.recluster_ll_tol is not None and self._comparable(X, record) and self.fit_score is not None:
+			score = self.clusterer.score(X)
+			if score is not None and self.fit_score - score >= self.recluster_ll_tol:
+				return False
+		return True
+
+	def _fitCluster(self, X, record):
+		self.applyCluster() # one fit in flight at a time
+		self.refits += 1
+		if self._skipRecluster(X, record):
+			self.skipped_refits += 1
+			cluster_output = self.cluster_output
+			if self.reassign and self._comparable(X, record):
+				cluster_output = np.concatenate([self.clusterer.predict(X[i:i+self.predict_chunk_size], self.train_labels[i:i+self.predict_chunk_size])
+					for i in range(0, X.shape[0], self.predict_chunk_size)])
+			self.log('| - trajectories barely moved, refit skipped ({}/{} skipped so far)'.format(self.skipped_refits, self.refits), 1)
+			self._setCluster(self.clusterer, cluster_output, record)
+			return
+		self.fit_column = np.array(self.traject_store.view()[:, -1])
+		self.fit_width = X.shape[1]
+		sample = None
+		if self.fit_subsample and self.fit_subsample < X.shape[0]:
+			sample = self._subsampleIndex(self.fit_subsample)
+		if self.k_candidates: # the sweep winner is already fitted, only assign
+			self.clusterer = self._selectNumCluster(X, sample)
+			self.num_cluster = self.clusterer.num_cluster
+			cluster_output = self.clusterer.assign(X, self.train_labels, self.predict_chunk_size)
+			self._setCluster(self.clusterer, cluster_output, record, X)
+			return
+		if self.clusterer is None:
+			self.clusterer = BACKENDS[self.cluster_backend](self.num_cluster, device=self.device, batch_size=self.cluster_batch_size,
+				warm_start=self.warm_start, warm_max_iter=self.warm_max_iter, n_jobs=self.class_workers,
+				trace_memory=self.trace_cluster_memory)
+		if self.async_cluster:
+			if self.cluster_pool is None:
+				self.cluster_pool = ProcessPoolExecutor(max_workers=1)
+			matrix = SharedMatrix(X, copy=True)
+			self.clusterer.to('cpu') # the pool forks, the child must not touch cuda
+			future = self.cluster_pool.submit(fit_cluster, matrix, self.clusterer, self.train_labels.copy(), sample, self.predict_chunk_size)
+			self.cluster_pending = (future, matrix, record)
+			return future
+		cluster_output = self.clusterer.fit_predict(X, self.train_labels, sample, self.predict_chunk_size)
+		self._setCluster(self.clusterer, cluster_output, record, X)
+
+	def _setCluster(self, clusterer, cluster_output, record, X=None):
+		self.clusterer = clusterer
+		self.cluster_output = cluster_output
+		if record:
+			self.cluster_store.append_epoch(cluster_output)
+		if X is not None and self.recluster_ll_tol is not None:
+			self.fit_score = clusterer.score(X)
+		self.log('| - cluster backend {}: {}'.format(self.cluster_backend, clusterer.report), 2)
+
+	def applyCluster(self, block=True):
+		"""
+		Install the result of a pending asynchronous clustering, waiting for it unless
+		`block` is False. Returns whether nothing is left pending.
+		"""
+		if self.cluster_pending is None:
+			return True
+		future, matrix, record = self.cluster_pending
+		if not block and not future.done():
+			return False
+		clusterer, cluster_output = future.result()
+		clusterer.to(self.device)
+		self.cluster_pending = None
+		self._setCluster(clusterer, cluster_output, record, matrix.array())
+		matrix.release()
+		return True
+
 	def clusterTrajectory(self):
-		self.gmmCluster = mixture.GaussianMixture(n_components=self.num_cluster, covariance_type='full', max_iter=500, tol=1e-5, init_params='kmeans', verbose=0)
-		#self.gmmCluster = GaussianMixture(self.num_cluster, self.traject_matrix.shape[1], iprint=0)
-		self.gmmCluster.fit(self.traject_matrix)
-		self.cluster_output = self.gmmCluster.predict(self.traject_matrix)
+		"""
+		Cluster the trajectory into `cluster_output`. With async_cluster the fit runs on a
+		snapshot in a background process and a future is returned, the result is applied at
+		the first createTrajectory (or reweightData) after it finished. Until then
+		reweightData keeps using the last installed clustering, it only waits for the very
+		first one.
+		"""
+		traject = self.traject_store.view()
+		if self.embedder:
+			traject = self.embedder.transform(traject)
+		return self._fitCluster(traject, False)
 
 	def clusterBins(self):
-		self.gmmCluster = mixture.GaussianMixture(n_components=self.num_cluster, covariance_type='full', max_iter=500, tol=1e-5, init_params='kmeans', verbose=0)
-		#self.gmmCluster = GaussianMixture(self.num_cluster, self.traject_matrix.shape[1], iprint=0)
-		self.gmmCluster.fit(self.traject_bins)
-		self.cluster_output = self.gmmCluster.predict(self.traject_bins)
-		self.cluster_matrix = np.append(self.cluster_matrix, np.matrix(self.cluster_output).T, 1)
+		return self._fitCluster(self.traject_bins, True)
 
 
 	def _specialRatio(self, cidx, special_index):
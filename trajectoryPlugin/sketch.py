@@ -0,0 +1,45 @@
+import torch
+
+
+class GradientSketch:
+	"""
+	Seeded CountSketch of a model gradient into `dim` buckets: every entry of parameter tensor
+	i is added with a random sign to a random bucket, both drawn from a generator seeded with
+	`seed + i`, so inner products (and cosines) between sketches estimate the exact ones.
+
+		note: hashes (int32) and signs (int8) are drawn once per parameter tensor and cached,
+		5 bytes per parameter, the (K+1) x P gradient matrix of reweightData shrinks to
+		(K+1) x dim.
+	"""
+
+	def __init__(self, dim, seed=0):
+		self.dim = dim
+		self.seed = seed
+		self.hashes = {}
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['hashes'] = {} # pool workers redraw them instead of receiving 5 bytes per parameter
+		return state
+
+	def _hash(self, i, w):
+		key = (i, w.numel(), w.device)
+		if key not in self.hashes:
+			generator = torch.Generator(device=w.device) if w.is_cuda else torch.Generator()
+			generator.manual_seed(self.seed + i)
+			bucket = torch.randint(self.dim, (w.numel(),), generator=generator, device=w.device).int()
+			sign = (torch.randint(2, (w.numel(),), generator=generator, device=w.device) * 2 - 1).char()
+			self.hashes[key] = bucket, sign
+		bucket, sign = self.hashes[key]
+		return bucket.long(), sign.to(w.dtype)
+
+	def __call__(self, grads, params):
+		"""
+		Sketch of the gradients `grads` of `params` (None for unused ones), shape (dim,).
+		"""
+		sketch = torch.zeros(self.dim, device=params[0].device)
+		for i, (g, w) in enumerate(zip(grads, params)):
+			if g is not None:
+				bucket, sign = self._hash(i, w)
+				sketch.index_add_(0, bucket, sign * g.detach().reshape(-1))
+		return sketch
@@ -0,0 +1,137 @@
+import os, json
+import numpy as np
+
+
+class TrajectoryStore:
+	"""
+	Column buffer of per-epoch trajectories with shape (n_samples, n_epochs).
+
+		note: columns are kept in Fortran order so appending an epoch writes one
+		contiguous block, capacity doubles when full unless `capacity` is given
+		as the planned epoch count.
+	"""
+
+	def __init__(self, n_samples, capacity=None, dtype=np.float32):
+		self.n_samples = n_samples
+		self.dtype = np.dtype(dtype)
+		self.size = 0
+		self.data = self._allocate(capacity if capacity else 8)
+
+	def _allocate(self, capacity):
+		return np.empty((self.n_samples, capacity), dtype=self.dtype, order='F')
+
+	@property
+	def capacity(self):
+		return self.data.shape[1]
+
+	def _grow(self, capacity):
+		data = self._allocate(capacity)
+		data[:, :self.size] = self.data[:, :self.size]
+		self.data = data
+
+	def append_epoch(self, probs):
+		probs = np.asarray(probs).reshape(-1)
+		assert probs.shape[0] == self.n_samples
+		if self.size == self.capacity:
+			self._grow(2 * self.capacity)
+		self.data[:, self.size] = probs
+		self.size += 1
+
+	def view(self):
+		"""
+		Zero-copy view of the recorded epochs.
+		"""
+		return self.data[:, :self.size]
+
+	def __len__(self):
+		return self.size
+
+
+class MemmapTrajectoryStore(TrajectoryStore):
+	"""
+	TrajectoryStore backed by a column-major file on disk, read back through np.memmap views.
+
+		note: the file grows by `chunk` epochs at a time, older columns never move so an
+		append is one sequential write. Shape and dtype are kept in a `<path>.json` sidecar,
+		pass `resume=True` to continue from an existing file.
+	"""
+
+	def __init__(self, path, n_samples, capacity=None, dtype=np.float32, chunk=16, resume=False):
+		self.path = path
+		self.meta_path = path + '.json'
+		self.chunk = chunk
+		self.n_samples = n_samples
+		self.dtype = np.dtype(dtype)
+		self.size = 0
+		if resume and os.path.exists(self.path) and os.path.exists(self.meta_path):
+			with open(self.meta_path, 'r') as f:
+				meta = json.load(f)
+			assert meta['n_samples'] == n_samples and np.dtype(meta['dtype']) == self.dtype, 'trajectory file does not match the training set'
+			self.size = meta['size']
+			self.data = self._open(max(meta['capacity'], capacity or 0), 'r+')
+		else:
+			self.data = self._open(capacity if capacity else chunk, 'w+')
+			self._writeMeta()
+
+	def _open(self, capacity, mode):
+		if mode == 'r+' and os.path.getsize(self.path) < self.n_samples * capacity * self.dtype.itemsize:
+			with open(self.path, 'r+b') as f:
+				f.truncate(self.n_samples * capacity * self.dtype.itemsize)
+		return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=(self.n_samples, capacity), order='F')
+
+	def _grow(self, capacity):
+		self.data.flush()
+		del self.data
+		self.data = self._open(self.size + self.chunk, 'r+')
+
+	def _writeMeta(self):
+		with open(self.meta_path, 'w') as f:
+			json.dump({'n_samples': self.n_samples, 'dtype': self.dtype.str, 'size': self.size, 'capacity': self.capacity}, f)
+
+	def append_epoch(self, probs):
+		super(MemmapTrajectoryStore, self).append_epoch(probs)
+		self.data.flush()
+		self._writeMeta()
+
+
+class TrajectoryBins:
+	"""
+	Sliding-window mean and std of the trajectory, maintained as each epoch is appended.
+
+		note: bin i covers epochs i..i+window-1 (truncated at the latest epoch). Only the
+		`window` open bins keep running sums, features are written interleaved as
+		[mean_0, std_0, mean_1, std_1, ...] into `store`, so one epoch costs O(n_samples).
+	"""
+
+	def __init__(self, store, window=3):
+		self.store = store
+		self.window = window
+		self.size = 0
+		self.win_sum = np.zeros((store.n_samples, window))
+		self.win_sqr = np.zeros((store.n_samples, window))
+
+	def append_epoch(self, probs):
+		probs = np.asarray(probs, dtype=np.float64).reshape(-1, 1)
+		slot = self.size % self.window
+		self.win_sum[:, slot] = 0
+		self.win_sqr[:, slot] = 0
+		self.win_sum += probs
+		self.win_sqr += probs ** 2
+
+		# bin `self.size` opens, the previous window-1 bins gain one more epoch
+		self.store.append_epoch(np.zeros(self.store.n_samples))
+		self.store.append_epoch(np.zeros(self.store.n_samples))
+		features = self.store.view()
+		for i in range(max(0, self.size - self.window + 1), self.size + 1):
+			count = self.size - i + 1
+			mean = self.win_sum[:, i % self.window] / count
+			var = self.win_sqr[:, i % self.window] / count - mean ** 2
+			features[:, 2 * i] = mean
+			features[:, 2 * i + 1] = np.sqrt(np.clip(var, 0, None))
+		self.size += 1
+
+	def view(self):
+		return self.store.view()
+
+	def __len__(self):
+		return self.size
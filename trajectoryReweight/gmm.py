@@ -1,17 +1,25 @@
+import math
 import numpy as np
 import torch
 
 
 class GaussianMixture(torch.nn.Module):
+	"""
+	Diagonal-covariance Gaussian mixture fitted by EM in torch.
 
-	def __init__(self, n_components, n_features, n_iter=500, tol=1e-5, iprint=0):
+		note: `n_init` random restarts are fitted together as one (n_init, K, D) batch and the
+		best log likelihood is kept, convergence is checked on the device and only read back
+		every `check_every` iterations.
+	"""
+
+	def __init__(self, n_components, n_features, n_iter=500, tol=1e-5, n_init=1, check_every=10, iprint=0):
 		super(GaussianMixture, self).__init__()
 
 		self.n_components, self.n_features = n_components, n_features
-		
+
 		#init mu
 		self.mu = torch.nn.Parameter(torch.rand(self.n_components, self.n_features), requires_grad=False)
-		
+
 		#init sigma
 		self.var = torch.nn.Parameter(torch.ones(self.n_components, self.n_features), requires_grad=False)
 
@@ -20,91 +28,164 @@ class GaussianMixture(torch.nn.Module):
 
 		self.n_iter = n_iter
 		self.tol = tol
+		self.n_init = n_init
+		self.check_every = check_every
 		self.iprint = iprint
 
-	def log_gaussian(self, x, mu, var):
-		gaussian = torch.distributions.normal.Normal(mu,torch.sqrt(var))
-		return gaussian.log_prob(x)
+	def log_gaussian(self, X, mu, var):
+		"""
+		Log density of every row of X under every component, shape (..., K, N). The square
+		is expanded so no K x N x D tensor is formed, in float64: with var at its 1e-6 clamp
+		(saturated trajectories) the float32 cancellation error reaches several nats.
+		"""
+		Xd, mud, prec = X.double(), mu.double(), 1. / var.double()
+		quad = torch.matmul(prec, (Xd**2).t()) - 2 * torch.matmul(mud * prec, Xd.t()) + torch.sum(mud**2 * prec, -1, keepdim=True)
+		log_det = torch.sum(torch.log(var.double()), -1, keepdim=True)
+		return (-0.5 * (quad.clamp(min=0) + log_det + X.shape[1] * math.log(2 * math.pi))).to(X.dtype)
 
 	def log(self, msg, level):
 		if self.iprint >= level:
 			print(msg)
 
 	def log_pk(self, X):
-		log_likelihoods = self.log_gaussian(
-			X[None, :, :], 
-			self.mu[:, None, :], 
-			self.var[:, None, :] 
-		)
-		return log_likelihoods.sum(-1)
-
-	def log_marginal_likelihood(self, X):
-		log_pk = torch.log(self.pi) + self.log_pk(X)
-		max_log_pk = torch.max(log_pk, 0, keepdim=True)[0]
-		return torch.mean(max_log_pk + torch.log(torch.sum(torch.exp(log_pk-max_log_pk), 0, keepdim=True))).numpy() # avg log marginal likelihood !important
-
-	def fit(self, X):
-
-		diff = self.tol 
-		self.score = 0
-		i = 0
-
-		Xt = torch.tensor(X,dtype=torch.float32)
+		return self.log_gaussian(X, self.mu, self.var)
 
-		# re-initial by random data points
-		rand_idx = np.random.choice(Xt.size()[0]-1, self.n_components, replace=False).tolist()
-		self.mu = torch.nn.Parameter(Xt[rand_idx], requires_grad=False)
+	def _e_step(self, X, mu, var, pi):
+		log_pk = torch.log(pi) + self.log_gaussian(X, mu, var)
+		log_norm = torch.logsumexp(log_pk, -2, keepdim=True)
+		return log_pk - log_norm, log_norm
 
-		while (i < self.n_iter) and (diff >= self.tol):
+	def _m_step(self, X, r_ik):
+		dem = torch.sum(r_ik, -1, keepdim=True) + 10 * np.finfo(np.float32).eps
+		pi = dem / X.shape[0]
+		mu = torch.matmul(r_ik, X) / dem
+		var = (torch.matmul(r_ik, X**2) / dem - mu**2).clamp(min=1e-6)
+		return mu, var, pi
 
-			pre_score = self.score
+	def _tensor(self, X):
+		return torch.as_tensor(np.asarray(X), dtype=torch.float32).to(self.mu.device)
 
-			# E-Step
-			log_pk = torch.log(self.pi) + self.log_pk(Xt)
-			max_log_pk = torch.max(log_pk, 0, keepdim=True)[0]
-			log_r_ik = log_pk - (max_log_pk + torch.log(torch.sum(torch.exp(log_pk-max_log_pk), 0, keepdim=True)))
-			r_ik = torch.exp(log_r_ik)
-
-			# M-Step
-			dem = torch.sum(r_ik, 1, keepdim=True)
-			#max_log_r_ik = torch.max(log_r_ik, 1, keepdim=True)[0]
-			#log_dem = max_log_r_ik + torch.log(torch.sum(torch.exp(log_r_ik - max_log_r_ik),1,keepdim=True))
-			#dem = torch.exp(log_dem)
-
-			self.pi.data = torch.div(dem, Xt.shape[0])
-			self.mu.data = torch.div(torch.mm(r_ik, Xt), dem)
-
-			for idx in range(self.n_components):
+	def log_marginal_likelihood(self, X):
+		_, log_norm = self._e_step(self._tensor(X), self.mu, self.var, self.pi)
+		return torch.mean(log_norm).item() # avg log marginal likelihood !important
 
-				sqr = (Xt - self.mu.data[idx])**2
+	def fit(self, X, warm_start=False):
 
-				tmp = torch.mm(r_ik[idx].unsqueeze(0), sqr)
+		Xt = self._tensor(X)
+		n = Xt.shape[0]
 
-				self.var.data[idx] = torch.div(tmp, dem[idx])
+		# restarts from random data points, unless continuing from the current mixture
+		if warm_start:
+			mu, var, pi = self.mu.data[None], self.var.data[None], self.pi.data[None]
+		else:
+			rand_idx = torch.stack([torch.randperm(n)[:self.n_components] for r in range(self.n_init)]).to(Xt.device)
+			mu = Xt[rand_idx]
+			var = Xt.var(0).clamp(min=1e-6).expand_as(mu).clone()
+			pi = torch.full((self.n_init, self.n_components, 1), 1./self.n_components, device=Xt.device)
 
-			self.score = self.log_marginal_likelihood(Xt)
+		score = torch.full((mu.shape[0],), -np.inf, device=Xt.device)
+		i = 0
+		while i < self.n_iter:
+			log_r_ik, log_norm = self._e_step(Xt, mu, var, pi)
+			mu, var, pi = self._m_step(Xt, torch.exp(log_r_ik))
 
-			diff = abs(self.score - pre_score)
+			pre_score, score = score, log_norm.mean(-1).squeeze(-1)
 			i += 1
 
-			self.log("| -- epoch = {}, log_likelihood = {}".format(i, self.score),1)
+			if self.iprint >= 1:
+				self.log("| -- epoch = {}, log_likelihood = {}".format(i, score.max().item()),1)
+			if i % self.check_every == 0 and bool(torch.all(torch.abs(score - pre_score) < self.tol)):
+				break
+
+		_, log_norm = self._e_step(Xt, mu, var, pi)
+		score = log_norm.mean(-1).squeeze(-1)
+		best = int(torch.argmax(score))
+		self.mu.data, self.var.data, self.pi.data = mu[best], var[best], pi[best]
+		self.score = score[best].item()
+		self.n_iter_ = i
+
+	def fit_online(self, X, batch_size=4096, n_epochs=1, step_decay=0.6, step_offset=2):
+		"""
+		Stochastic EM over mini-batches of rows of X (ndarray or np.memmap), memory stays at
+		one K x batch_size x D block whatever the number of rows.
+
+			note: batch sufficient statistics are blended into running ones with step size
+			(t + step_offset) ** -step_decay, step_decay in (0.5, 1] for convergence.
+		"""
+		n = X.shape[0]
+		rand_idx = np.sort(np.random.choice(n, self.n_components, replace=False))
+		self.mu.data = self._tensor(X[rand_idx])
+
+		s0, s1, s2 = None, None, None
+		t = 0
+		for epoch in range(n_epochs):
+			# visit contiguous row blocks in random order, sequential reads for memmap input
+			for start in np.random.permutation(np.arange(0, n, batch_size)):
+				Xt = self._tensor(X[start:start+batch_size])
+
+				# E-Step
+				log_r_ik, log_norm = self._e_step(Xt, self.mu, self.var, self.pi)
+				r_ik = torch.exp(log_r_ik)
+
+				# stochastic approximation of the sufficient statistics
+				b0 = torch.mean(r_ik, 1, keepdim=True)
+				b1 = torch.mm(r_ik, Xt) / Xt.shape[0]
+				b2 = torch.mm(r_ik, Xt**2) / Xt.shape[0]
+				eta = 1. if s0 is None else (t + step_offset) ** -step_decay
+				s0 = b0 if s0 is None else (1 - eta) * s0 + eta * b0
+				s1 = b1 if s1 is None else (1 - eta) * s1 + eta * b1
+				s2 = b2 if s2 is None else (1 - eta) * s2 + eta * b2
+
+				# M-Step
+				self.pi.data = s0 / torch.sum(s0)
+				self.mu.data = torch.div(s1, s0)
+				self.var.data = (torch.div(s2, s0) - self.mu.data**2).clamp(min=1e-6)
+
+				t += 1
+				if self.iprint >= 1:
+					self.log("| -- batch = {}, log_likelihood = {}".format(t, torch.mean(log_norm).item()),1)
+
+		self.score = torch.mean(log_norm).item()
+		self.n_iter_ = t
 
 	def append_fit(self, X, ex_size):
-		mu_extend = torch.nn.Parameter(torch.rand(self.n_components, ex_size), requires_grad=False)
-		var_extend = torch.nn.Parameter(torch.ones(self.n_components, ex_size), requires_grad=False)
+		"""
+		Warm-started refit after `ex_size` feature columns were appended to X: the new
+		columns of mu and var come from one M-step under the current responsibilities.
+		"""
+		Xt = self._tensor(X)
+		log_r_ik, _ = self._e_step(Xt[:, :self.n_features], self.mu, self.var, self.pi)
+		mu_extend, var_extend, _ = self._m_step(Xt[:, self.n_features:], torch.exp(log_r_ik))
 		self.mu = torch.nn.Parameter(torch.cat((self.mu, mu_extend), 1), requires_grad=False)
 		self.var = torch.nn.Parameter(torch.cat((self.var, var_extend), 1), requires_grad=False)
-		self.fit(X)
-
-	def predict(self, X, prob=True):
-		Xt = torch.tensor(X,dtype=torch.float32)
-
-		pk = torch.exp(self.log_pk(Xt))
+		self.n_features += ex_size
+		self.fit(X, warm_start=True)
+
+	def predict_log_proba(self, X, chunk_size=65536):
+		"""
+		Per-sample log responsibilities of shape (N, K), computed in log space one chunk
+		of `chunk_size` rows at a time.
+		"""
+		log_resp = np.empty((X.shape[0], self.n_components), dtype=np.float32)
+		with torch.no_grad():
+			for i in range(0, X.shape[0], chunk_size):
+				log_r_ik, _ = self._e_step(self._tensor(X[i:i+chunk_size]), self.mu, self.var, self.pi)
+				log_resp[i:i+chunk_size] = log_r_ik.t().cpu().numpy()
+		return log_resp
+
+	def predict(self, X, prob=True, chunk_size=65536):
+		"""
+		Per-sample responsibilities of shape (N, K) if `prob`, hard labels of shape (N,)
+		otherwise. Only one chunk of `chunk_size` rows is held on the device.
+		"""
 		if prob:
-			return (pk / torch.sum(pk)).numpy()
-		else:
-			_, predictions = torch.max(pk, 0)
-			return torch.squeeze(predictions).type(torch.LongTensor).numpy()
+			return np.exp(self.predict_log_proba(X, chunk_size))
+		predictions = np.empty(X.shape[0], dtype=np.int64)
+		with torch.no_grad():
+			for i in range(0, X.shape[0], chunk_size):
+				log_pk = torch.log(self.pi) + self.log_pk(self._tensor(X[i:i+chunk_size]))
+				predictions[i:i+chunk_size] = torch.argmax(log_pk, 0).cpu().numpy()
+		return predictions
 
 	def get_model(self):
-		return self.mu, self.var
\ No newline at end of file
+		return self.mu, self.var
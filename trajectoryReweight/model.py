@@ -3,9 +3,8 @@ import torch.nn as nn
 import torch.utils.data as Data
 import torchvision
 import numpy as np
-from copy import deepcopy
 from trajectoryReweight.gmm import GaussianMixture
-from scipy import spatial
+from trajectoryPlugin.store import TrajectoryStore
 
 
 class WeightedCrossEntropyLoss(nn.Module):
@@ -91,7 +90,7 @@ class TrajectoryReweightNN:
 		"""
 		self.log('Train {} burn-in epoch...'.format(self.burnin), 1)
 		
-		self.traject_matrix = []
+		self.traject_store = TrajectoryStore(len(y_train_tensor), self.num_iter, np.float32)
 		epoch = 1
 		scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=1, gamma=0.95)
 		while epoch <= self.burnin:
@@ -110,11 +109,11 @@ class TrajectoryReweightNN:
 				for step, (data, target, weight) in enumerate(reweight_loader):
 					data = data.to(self.device)
 					train_output.extend(self.torchnn(data).data.cpu().numpy().tolist())
-				self.traject_matrix.append(self.correct_prob(train_output, y_train_tensor.cpu().numpy()))
+				self.traject_store.append_epoch(self.correct_prob(train_output, y_train_tensor.cpu().numpy()))
+				self.traject_matrix = self.traject_store.view()
 			test_loss, correct = self.evaluate(test_loader)
 			self.log('epoch = {} | test loss = {:.4f} | test accuarcy = {}% [{}/{}]'.format(epoch, test_loss, 100*correct/len(test_loader.dataset), correct, len(test_loader.dataset)), 2)
 			epoch += 1
-		self.traject_matrix = np.array(self.traject_matrix).T
 		self.log('Train {} burn-in epoch complete.\n'.format(self.burnin) + '-'*60, 1)
 
 		"""
@@ -155,8 +154,8 @@ class TrajectoryReweightNN:
 					data = data.to(self.device)
 					output = self.torchnn(data)
 					train_output.extend(output.data.cpu().numpy().tolist())
-				new_trajectory = np.array(self.correct_prob(train_output,y_train_tensor.cpu().numpy())).reshape(-1,1)
-				self.traject_matrix = np.append(self.traject_matrix,new_trajectory,1)
+				self.traject_store.append_epoch(self.correct_prob(train_output,y_train_tensor.cpu().numpy()))
+				self.traject_matrix = self.traject_store.view()
 
 				valid_loss, correct = self.evaluate(valid_loader)
 				valid_accuracy = 100 * correct / len(valid_loader.dataset)
@@ -181,41 +180,47 @@ class TrajectoryReweightNN:
 		self.torchnn.load_state_dict(torch.load('checkpoint.pt'))
 		self.log('Trajectory based training complete, best validation loss = {} at epoch = {}.'.format(best_score, best_epoch), 1)
 
+	def flat_grad(self, x_tensor, y_tensor, params):
+		"""
+		Gradient of the mean loss of (x_tensor, y_tensor) w.r.t. `params` as one flat tensor on
+		the device, accumulated over batches of `batch_size` with torch.autograd.grad so the
+		parameters' .grad (and the optimizer) are left untouched.
+		"""
+		flat = torch.zeros(sum(w.numel() for w in params), device=self.device)
+		for i in range(0, len(y_tensor), self.batch_size):
+			data, target = x_tensor[i:i+self.batch_size].to(self.device), y_tensor[i:i+self.batch_size].to(self.device)
+			loss = self.loss_func(self.torchnn(data), target, None) * len(target) / len(y_tensor)
+			grads = torch.autograd.grad(loss, params, allow_unused=True)
+			flat += torch.cat([g.reshape(-1) if g is not None else torch.zeros(w.numel(), device=self.device) for g, w in zip(grads, params)])
+		return flat
+
 	def reweight(self, x_train_tensor, y_train_tensor, x_valid_tensor, y_valid_tensor, special_index):
-		valid_grad = []
-		validNet = deepcopy(self.torchnn)
-		valid_output = validNet(x_valid_tensor.to(self.device))
-		valid_loss = self.loss_func(valid_output, y_valid_tensor.to(self.device), None)
-		self.optimizer.zero_grad()
-		valid_loss.backward()
-		for w in validNet.parameters():
-			if w.requires_grad:
-				valid_grad.extend(list(w.grad.cpu().detach().numpy().flatten()))
-		valid_grad = np.array(valid_grad)
-		
+		# gradients of the live model in eval mode, no snapshot, training mode restored afterwards
+		training = self.torchnn.training
+		self.torchnn.eval()
+		params = [w for w in self.torchnn.parameters() if w.requires_grad]
+		valid_grad = self.flat_grad(x_valid_tensor, y_valid_tensor, params)
+
+		# cluster gradients stacked in one K x P matrix, similarities in one matmul
+		cluster_grads = torch.zeros(self.num_cluster, valid_grad.numel(), device=valid_grad.device)
 		for cid in range(self.num_cluster):
-			subset_grads = []
-			cidx = (self.cluster_output==cid).nonzero()[0].tolist()
-			x_cluster = x_train_tensor[cidx]
-			y_cluster = y_train_tensor[cidx]
+			cidx = (self.cluster_output==cid).nonzero()[0]
 			size = len(cidx)
 			if size == 0:
 				continue
 			sample_size = min(int(size), 2000)
-			sample_idx = np.random.choice(range(size), sample_size, replace=False).tolist()
-			x_subset = x_cluster[sample_idx]
-			y_subset = y_cluster[sample_idx]
-
-			subset_output = validNet(x_subset.to(self.device))
-			subset_loss = self.loss_func(subset_output, y_subset.to(self.device), None)
-			self.optimizer.zero_grad()
-			subset_loss.backward()
-			for w in validNet.parameters():
-				if w.requires_grad:
-					subset_grads.extend(list(w.grad.cpu().detach().numpy().flatten()))
-			subset_grads = np.array(subset_grads)
-			sim = 1 - spatial.distance.cosine(valid_grad, subset_grads)
+			sample_idx = torch.from_numpy(np.random.choice(cidx, sample_size, replace=False))
+			cluster_grads[cid] = self.flat_grad(x_train_tensor[sample_idx], y_train_tensor[sample_idx], params)
+		self.torchnn.train(training)
 
+		norm = torch.norm(cluster_grads, 2, 1) * torch.norm(valid_grad, 2)
+		sims = (torch.mv(cluster_grads, valid_grad) / norm.clamp(min=1e-12)).cpu().numpy().tolist()
+		for cid in range(self.num_cluster):
+			cidx = (self.cluster_output==cid).nonzero()[0].tolist()
+			size = len(cidx)
+			if size == 0:
+				continue
+			sim = sims[cid]
 			self.weight_tensor[cidx] += 0.05 * sim
 			self.weight_tensor[cidx] = self.weight_tensor[cidx].clamp(0.001)
 			if special_index != []: